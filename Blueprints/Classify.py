@@ -3,18 +3,79 @@ from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
 import os
-import base64
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from firebase.firebase import db
+from util.cache import ResponseCache, normalize_text
 from util.classes import Question
 
 classify = Blueprint('classify', __name__,)
 load_dotenv()
 
+MODEL = "gemini-2.5-flash"
+IMAGE_FETCH_TIMEOUT_SECONDS = 10
+IMAGE_FETCH_WORKERS = 8
+CLASSIFY_BATCH_WORKERS = 8
+MAX_CLASSIFY_BATCH_SIZE = 50
+DEFAULT_IMAGE_MIME_TYPE = "image/png"
+TAG_DELETE_TABLE = str.maketrans("", "", '[]"')
+
+# One pooled session per process; pool_maxsize covers every image worker
+# hitting the same host so connections are reused instead of discarded.
+# A single quick retry keeps a dead host from stalling a request for
+# several timeouts in a row.
+http = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=IMAGE_FETCH_WORKERS,
+    max_retries=Retry(total=1, connect=1, backoff_factor=0.2)
+)
+http.mount("https://", http_adapter)
+http.mount("http://", http_adapter)
+image_pool = ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS)
+# Bounds concurrent Gemini calls from batch requests to respect rate limits.
+classify_pool = ThreadPoolExecutor(max_workers=CLASSIFY_BATCH_WORKERS)
+
+QUESTION_INSTRUCTIONS = (
+    "You are designed to classify questions with tags.\n"
+    "Given the following question and any associated hints (text possibly with an image), "
+    "return a comma-separated list of appropriate tags from broad to specific."
+)
+COURSE_INSTRUCTIONS = (
+    "You are designed to classify courses into broad and specific subject tags.\n"
+    "Given the course name, return a comma-separated list of relevant tags, "
+    "from broad to specific."
+)
+UNIT_INSTRUCTIONS = (
+    "You are designed to classify units of study into relevant subject tags.\n"
+    "Given the unit's name, return a comma-separated list of lowercase tags "
+    "from broad to specific."
+)
+
 class Classifier:
     def __init__(self):
         self.client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+        # Keys include the model and instructions, so prompt edits invalidate old tags.
+        self.responses = ResponseCache(maxsize=2048, ttl=86400)
+
+    def generate(self, instructions: str, contents) -> str:
+        response = self.client.models.generate_content(
+            model=MODEL,
+            contents=contents,
+            config=types.GenerateContentConfig(system_instruction=instructions)
+        )
+        return response.text
+
+    def parseTags(self, raw: str) -> List[str]:
+        tags = {}
+        for tag in raw.translate(TAG_DELETE_TABLE).split(","):
+            tag = tag.strip().lower()
+            if tag:
+                tags.setdefault(tag, None)
+        return list(tags)
     
     def getQuestionData(self, doc_id: str) -> Optional[Question]:
         doc_ref = db.collection("questions").document(doc_id)
@@ -26,18 +87,45 @@ class Classifier:
 
         data = doc.to_dict()
         return data  
+
+    def fetchImage(self, image_url: str) -> Optional[types.Part]:
+        try:
+            response = http.get(image_url, timeout=IMAGE_FETCH_TIMEOUT_SECONDS)
+            response.raise_for_status()
+            mime_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+            if not mime_type.startswith("image/"):
+                mime_type = DEFAULT_IMAGE_MIME_TYPE
+            return types.Part.from_bytes(data=response.content, mime_type=mime_type)
+        except Exception as e:
+            print(f"Error fetching image from {image_url}: {e}")
+            return None
     
     def classifyQuestion(self, question: Question) -> List[str]:
+        key = ResponseCache.key(
+            MODEL,
+            QUESTION_INSTRUCTIONS,
+            normalize_text(question["question"]),
+            *(
+                (normalize_text(hint.get("title")), normalize_text(hint.get("content", "")), hint.get("image"))
+                for hint in question.get("hints", [])
+            )
+        )
+        cached = self.responses.get(key)
+        if cached is not None:
+            return cached
+
         parts: list[types.Part] = []
 
-        parts.append(types.Part(text=
-            "You are designed to classify questions with tags.\n"
-            "Given the following question and any associated hints (text possibly with an image), "
-            "return a comma-separated list of appropriate tags from broad to specific.\n\n"
-            f"Question:\n{question['question']}\n\nHints:"
+        parts.append(types.Part(text=f"Question:\n{question['question']}\n\nHints:"))
+
+        hints = question.get("hints", [])
+        image_urls = list(dict.fromkeys(
+            hint.get("image") for hint in hints
+            if hint.get("image") and hint.get("image").startswith("http")
         ))
+        images = dict(zip(image_urls, image_pool.map(self.fetchImage, image_urls)))
 
-        for hint in question.get("hints", []):
+        for hint in hints:
             title = hint.get("title")
             content = hint.get("content", "")
 
@@ -49,34 +137,14 @@ class Classifier:
                 parts.append({
                     "text": f"\n\nHint Content: {content}"
                 })
-            image_url = hint.get("image")
-            if image_url and image_url.startswith("http"):
-                try:
-                    image_bytes = requests.get(image_url).content
-                    base64_data = base64.b64encode(image_bytes).decode("utf-8")
-                    parts.append({
-                        "inline_data": {
-                            "mime_type": "image/png",  
-                            "data": base64_data
-                        }
-                    })
-                except Exception as e:
-                    print(f"Error fetching image from {image_url}: {e}")
-
-
-        response = self.client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=parts
-        )
+            image_part = images.get(hint.get("image"))
+            if image_part:
+                parts.append(image_part)
 
-        raw = response.text.strip()
-        tags = [
-            tag.strip().lower()
-            for tag in raw.replace("[", "").replace("]", "").replace('"', "").split(",")
-            if tag.strip()
-        ]
 
-        return list(dict.fromkeys(tags))
+        tags = self.parseTags(self.generate(QUESTION_INSTRUCTIONS, parts))
+        self.responses.set(key, tags)
+        return tags
 
     def getQuestionTags(self, doc_id: str) -> Optional[str]:
         question = self.getQuestionData(doc_id)
@@ -85,45 +153,38 @@ class Classifier:
         return self.classifyQuestion(question)
     
     def classifyCourse(self, course_name: str) -> List[str]:
-        prompt = (
-            "You are designed to classify courses into broad and specific subject tags.\n"
-            "Given the course name, return a comma-separated list of relevant tags, "
-            "from broad to specific.\n\n"
-            f"Course Name: {course_name}\n"
-        )
-        response = self.client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt
-        )
+        key = ResponseCache.key(MODEL, COURSE_INSTRUCTIONS, normalize_text(course_name))
+        cached = self.responses.get(key)
+        if cached is not None:
+            return cached
+
+        prompt = f"Course Name: {course_name}\n"
+        tags = self.parseTags(self.generate(COURSE_INSTRUCTIONS, prompt))
+        self.responses.set(key, tags)
+        return tags
+
+    def tryClassifyCourse(self, course_name: str) -> Optional[List[str]]:
+        try:
+            return self.classifyCourse(course_name)
+        except Exception as e:
+            print(f"Error classifying course {course_name}: {e}")
+            return None
 
-        raw = response.text.strip()
-        tags = [
-            tag.strip().lower()
-            for tag in raw.replace("[", "").replace("]", "").replace('"', "").split(",")
-            if tag.strip()
-        ]
-        return list(dict.fromkeys(tags))
+    def classifyCoursesBatch(self, course_names: List[str]) -> List[Optional[List[str]]]:
+        unique_names = list(dict.fromkeys(course_names))
+        tags = dict(zip(unique_names, classify_pool.map(self.tryClassifyCourse, unique_names)))
+        return [tags[name] for name in course_names]
 
     def classifyUnit(self, unit_name: str) -> List[str]:
-        prompt = (
-            "You are designed to classify units of study into relevant subject tags.\n"
-            "Given the unit's name, return a comma-separated list of lowercase tags "
-            "from broad to specific.\n\n"
-            f"Unit Name: {unit_name}"
-        )
-        
-        response = self.client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt
-        )
+        key = ResponseCache.key(MODEL, UNIT_INSTRUCTIONS, normalize_text(unit_name))
+        cached = self.responses.get(key)
+        if cached is not None:
+            return cached
 
-        raw = response.text.strip()
-        tags = [
-            tag.strip().lower()
-            for tag in raw.replace("[", "").replace("]", "").replace('"', "").split(",")
-            if tag.strip()
-        ]
-        return list(dict.fromkeys(tags))
+        prompt = f"Unit Name: {unit_name}"
+        tags = self.parseTags(self.generate(UNIT_INSTRUCTIONS, prompt))
+        self.responses.set(key, tags)
+        return tags
 
 classifier = Classifier()
 
@@ -154,6 +215,20 @@ def courseClassify():
 
     return jsonify({"tags": tags})
 
+@classify.route('/coursesClassifyBatch', methods=['POST'])
+def coursesClassifyBatch():
+    data = request.json
+    course_names = data.get('course_names')
+
+    if not isinstance(course_names, list) or not course_names:
+        return jsonify({"error": "Missing 'course_names'"}), 400
+    if len(course_names) > MAX_CLASSIFY_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_CLASSIFY_BATCH_SIZE} 'course_names' per request"}), 400
+    if not all(isinstance(name, str) and name for name in course_names):
+        return jsonify({"error": "Invalid 'course_names'"}), 400
+
+    tags = classifier.classifyCoursesBatch(course_names)
+    return jsonify({"tags": tags})
 
 @classify.route('/unitClassify', methods=['POST'])
 def unitClassify():
@@ -163,9 +238,7 @@ def unitClassify():
     if not unit_name:
         return jsonify({"error": "Missing 'unit_name'"}), 400
 
-    tags = classifier.classifyUnit({
-        "unit_name": unit_name,
-    })
+    tags = classifier.classifyUnit(unit_name)
     if tags is None:
         return jsonify({"error": "No tags"}), 404
 
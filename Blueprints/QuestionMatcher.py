@@ -1,80 +1,158 @@
 import logging
+import os
 from flask import Blueprint, request, jsonify
-from typing import List, Dict, Set, Optional
-from pyparsing import Iterable
+from typing import List, Dict, FrozenSet, Set, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud.firestore_v1.base_query import FieldFilter
 from firebase.firebase import db
+from util.cache import ResponseCache
+from util.tags import TagVocabulary, split_tags
+import hashlib
+import heapq
 import random
-import re
 
 question_match = Blueprint("question_match", __name__)
-STOPWORDS = {"the", "and", "or", "of", "a", "an", "in", "on", "to", "for", "by", "with", "at", "from", "as", "is"}
-
-logging.basicConfig(level=logging.DEBUG)
+# Firestore caps the number of values in an array_contains_any filter.
+ARRAY_CONTAINS_ANY_LIMIT = 30
+# effective_tags is only written by scripts/backfill_tags.py, so the indexed
+# candidate lookup stays off until something keeps the field current on every
+# question, course and unit write.
+USE_EFFECTIVE_TAGS_INDEX = os.getenv("USE_EFFECTIVE_TAGS_INDEX", "").lower() in ("1", "true")
+# The only question fields find_relevant_questions reads.
+CANDIDATE_FIELDS = ["tags", "course", "unit", "course_name", "unit_name"]
+
+query_pool = ThreadPoolExecutor(max_workers=8)
+# Course and unit tags are read on every request but rarely edited; a short TTL
+# bounds how long an edit takes to show up.
+tag_cache = ResponseCache(maxsize=4096, ttl=300)
+# Keyed on a digest of the learning state, so likes/answers miss immediately
+# and the TTL only bounds catalog staleness.
+result_cache = ResponseCache(maxsize=1024, ttl=60)
+LEARNING_STATE_FIELDS = ["likedQuestions", "dislikedQuestions", "answeredQuestions", "subscribedCourses"]
+
+logger = logging.getLogger(__name__)
 
 class QuestionMatcher:
     def get_user_learning_state(self, uid: str, course: str) -> Optional[dict]:
-        logging.info("1. Fetching user learning state for user '%s' and course '%s'", uid, course)
+        logger.info("1. Fetching user learning state for user '%s' and course '%s'", uid, course)
         doc = db.collection("learning").document(uid).collection("courses").document(course).get()
         return doc.to_dict() if doc.exists else None
 
-    def split_tags(self, tags: Iterable[str]) -> Set[str]:
-        words = set()
-        for tag in tags:
-            tag = tag.lower()
-            tag = re.sub(r"[-/]", " ", tag)
-            tag = re.sub(r"[^\w\s]", "", tag)
-            for word in tag.split():
-                if word in STOPWORDS or not word.strip():
-                    continue
-                if word.endswith("s") and len(word) > 3:
-                    word = word[:-1]
-                words.add(word)
-        return words
+    def get_learning_state_digest(self, user_data: dict) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        for field in LEARNING_STATE_FIELDS:
+            digest.update("\x1f".join(sorted(map(str, user_data.get(field, [])))).encode("utf-8"))
+            digest.update(b"\x1e")
+        return digest.hexdigest()
 
     def get_question_tags(self, question_ids: List[str]) -> Set[str]:
         tags = set()
-        for qid in question_ids:
-            doc = db.collection("questions").document(qid).get()
+        if not question_ids:
+            return tags
+        refs = [db.collection("questions").document(qid) for qid in question_ids]
+        for doc in db.get_all(refs, field_paths=["tags"]):
             if doc.exists:
-                raw_tags = doc.to_dict().get("tags", [])
-                split = self.split_tags(raw_tags)
-                logging.info("2. Tags for question '%s': %s", qid, split)
+                split = split_tags(doc.to_dict().get("tags", []))
+                logger.info("2. Tags for question '%s': %s", doc.id, split)
                 tags.update(split)
         return tags
 
-    def get_course_tags(self, course_id: str) -> Set[str]:
-        doc = db.collection("courses").document(course_id).get()
-        if doc.exists:
-            raw_tags = doc.to_dict().get("tags", [])
-            tags = self.split_tags(raw_tags)
-            logging.info("3. Tags for course '%s': %s", course_id, tags)
+    def get_course_tags(self, course_id: str) -> FrozenSet[str]:
+        key = ("course", course_id)
+        tags = tag_cache.get(key)
+        if tags is not None:
             return tags
-        return set()
 
-    def get_unit_tags(self, course_id: str, unit_id: Optional[str]) -> Set[str]:
+        doc = db.collection("courses").document(course_id).get(field_paths=["tags"])
+        tags = frozenset(split_tags(doc.to_dict().get("tags", []))) if doc.exists else frozenset()
+        logger.info("3. Tags for course '%s': %s", course_id, tags)
+        tag_cache.set(key, tags)
+        return tags
+
+    def get_unit_tags(self, course_id: str, unit_id: Optional[str]) -> FrozenSet[str]:
         if not unit_id:
-            return set()
+            return frozenset()
+        key = ("unit", course_id, unit_id)
+        tags = tag_cache.get(key)
+        if tags is not None:
+            return tags
+
         doc = (
             db.collection("courses")
             .document(course_id)
             .collection("units")
             .document(unit_id)
-            .get()
+            .get(field_paths=["tags"])
         )
-        if doc.exists:
-            raw_tags = doc.to_dict().get("tags", [])
-            tags = self.split_tags(raw_tags)
-            logging.info("4. Tags for unit '%s' in course '%s': %s", unit_id, course_id, tags)
-            return tags
-        return set()
+        tags = frozenset(split_tags(doc.to_dict().get("tags", []))) if doc.exists else frozenset()
+        logger.info("4. Tags for unit '%s' in course '%s': %s", unit_id, course_id, tags)
+        tag_cache.set(key, tags)
+        return tags
 
-    def get_effective_tags(self, question: dict) -> Set[str]:
-        qtags = self.split_tags(question.get("tags", []))
-        course_id = question.get("course")
-        unit_id = question.get("unit")
-        effective = qtags | self.get_course_tags(course_id) | self.get_unit_tags(course_id, unit_id)
-        logging.debug("5. Effective tags for question '%s': %s", question.get("id", "unknown"), effective)
-        return effective
+    def get_candidate_tag_maps(
+        self, candidates: List[dict]
+    ) -> Tuple[Dict[str, FrozenSet[str]], Dict[Tuple[str, str], FrozenSet[str]]]:
+        # Returned as request-local maps so scoring never falls back to a document
+        # read when tag_cache evicts an entry mid-request.
+        course_tag_map = {}
+        unit_tag_map = {}
+        refs = []
+        for qdata in candidates:
+            course_id = qdata.get("course")
+            unit_id = qdata.get("unit")
+            if not course_id:
+                continue
+            if course_id not in course_tag_map:
+                tags = course_tag_map[course_id] = tag_cache.get(("course", course_id))
+                if tags is None:
+                    refs.append(db.collection("courses").document(course_id))
+            if unit_id and (course_id, unit_id) not in unit_tag_map:
+                tags = unit_tag_map[(course_id, unit_id)] = tag_cache.get(("unit", course_id, unit_id))
+                if tags is None:
+                    refs.append(db.collection("courses").document(course_id).collection("units").document(unit_id))
+
+        if refs:
+            for doc in db.get_all(refs, field_paths=["tags"]):
+                tags = frozenset(split_tags(doc.to_dict().get("tags", []))) if doc.exists else frozenset()
+                parent_course = doc.reference.parent.parent
+                if parent_course is None:
+                    course_tag_map[doc.id] = tags
+                    tag_cache.set(("course", doc.id), tags)
+                else:
+                    unit_tag_map[(parent_course.id, doc.id)] = tags
+                    tag_cache.set(("unit", parent_course.id, doc.id), tags)
+        return course_tag_map, unit_tag_map
+
+    def query_candidate_questions(self, query) -> List[dict]:
+        candidates = []
+        for doc in query.select(CANDIDATE_FIELDS).stream():
+            qdata = doc.to_dict()
+            qdata["id"] = doc.id
+            candidates.append(qdata)
+        return candidates
+
+    def get_candidate_questions(self, curriculum_tags: Set[str]) -> List[dict]:
+        questions = db.collection("questions")
+        if not USE_EFFECTIVE_TAGS_INDEX:
+            # A question can match through its own, its course's or its unit's tags
+            # in any course, so without a current index every question is a candidate.
+            candidates = self.query_candidate_questions(questions)
+            logger.info("6. Found %d candidate questions", len(candidates))
+            return candidates
+
+        tags = sorted(curriculum_tags)
+        queries = [
+            questions.where(filter=FieldFilter(
+                "effective_tags", "array_contains_any", tags[i:i + ARRAY_CONTAINS_ANY_LIMIT]
+            ))
+            for i in range(0, len(tags), ARRAY_CONTAINS_ANY_LIMIT)
+        ]
+        candidates = {}
+        for chunk_candidates in query_pool.map(self.query_candidate_questions, queries):
+            for qdata in chunk_candidates:
+                candidates.setdefault(qdata["id"], qdata)
+        logger.info("6. Found %d candidate questions", len(candidates))
+        return list(candidates.values())
 
     def find_relevant_questions(
     self,
@@ -88,44 +166,60 @@ class QuestionMatcher:
     disliked_threshold: float = 0.4,
     reference_course_id: Optional[str] = None, 
     reference_unit_id: Optional[str] = None  
-) -> List[Dict]:
-        matched = []
+) -> Dict[Tuple[str, str], Dict]:
+        # Matches are accumulated straight into their (course, unit) group.
+        grouped = {}
         curriculum_tags = course_tags | unit_tags
-        logging.info("6. Curriculum tags: %s", curriculum_tags)
-
-        for doc in db.collection("questions").stream():
-            qdata = doc.to_dict()
-            qid = doc.id
-            qdata["id"] = qid
+        logger.info("6. Curriculum tags: %s", curriculum_tags)
+        if not curriculum_tags:
+            return grouped
+
+        candidates = self.get_candidate_questions(curriculum_tags)
+
+        vocab = TagVocabulary()
+        curriculum_mask = vocab.mask(curriculum_tags)
+        liked_mask = vocab.mask(liked_tags)
+        # Disliked tags that are also curriculum tags never count against a question.
+        disallowed_mask = vocab.mask(disliked_tags) & ~curriculum_mask
+        num_required = len(curriculum_tags)
+
+        # Scored against live course/unit tags; masks are built once per course and unit.
+        course_tag_map, unit_tag_map = self.get_candidate_tag_maps(candidates)
+        course_masks = {}
+        unit_masks = {}
+
+        for qdata in candidates:
+            qid = qdata["id"]
+            course_id = qdata.get("course")
+            unit_id = qdata.get("unit")
 
-            effective_tags = self.get_effective_tags(qdata)
-            if not effective_tags:
-                logging.debug("7. Skipping question '%s': no effective tags", qid)
+            course_mask = course_masks.get(course_id)
+            if course_mask is None:
+                course_mask = course_masks[course_id] = vocab.mask(course_tag_map.get(course_id) or ())
+            unit_mask = unit_masks.get((course_id, unit_id))
+            if unit_mask is None:
+                unit_mask = unit_masks[(course_id, unit_id)] = vocab.mask(unit_tag_map.get((course_id, unit_id)) or ())
+            effective_mask = vocab.mask(split_tags(qdata.get("tags", []))) | course_mask | unit_mask
+            num_effective = effective_mask.bit_count()
+            if not num_effective:
+                logger.debug("7. Skipping question '%s': no effective tags", qid)
                 continue
 
-            disallowed_disliked_tags = effective_tags & disliked_tags - curriculum_tags
-            dislike_ratio = len(disallowed_disliked_tags) / len(effective_tags)
+            dislike_ratio = (effective_mask & disallowed_mask).bit_count() / num_effective
             if dislike_ratio > disliked_threshold:
-                logging.debug("8. Skipping question '%s': too many disliked tags (%.2f)", qid, dislike_ratio)
-                continue
-
-            num_required = len(curriculum_tags)
-            if num_required == 0:
+                logger.debug("8. Skipping question '%s': too many disliked tags (%.2f)", qid, dislike_ratio)
                 continue
 
-            num_matched = len(effective_tags & curriculum_tags)
+            num_matched = (effective_mask & curriculum_mask).bit_count()
             match_ratio = num_matched / num_required
             if match_ratio < match_threshold:
-                logging.debug("9. Skipping question '%s': curriculum match ratio too low (%.2f)", qid, match_ratio)
+                logger.debug("9. Skipping question '%s': curriculum match ratio too low (%.2f)", qid, match_ratio)
                 continue
 
-            liked_overlap = len(effective_tags & liked_tags)
-            liked_ratio = liked_overlap / len(effective_tags)
+            liked_overlap = (effective_mask & liked_mask).bit_count()
+            liked_ratio = liked_overlap / num_effective
             liked_boost = round(liked_ratio * 2, 2)
 
-            course_id = qdata.get("course")
-            unit_id = qdata.get("unit")
-
             subscribed_boost = 1 if course_id in subscribed_courses else 0
             answered_penalty = -1 if qid in answered_questions else 0
             same_course_boost = 1 if course_id == reference_course_id else 0
@@ -133,62 +227,82 @@ class QuestionMatcher:
 
             priority = liked_boost + subscribed_boost + same_course_boost + same_unit_boost + answered_penalty
 
-            logging.info(
-                "10. Matched question '%s': liked=%d, match_ratio=%.2f, dislike_ratio=%.2f, priority=%.2f",
-                qid, liked_overlap, match_ratio, dislike_ratio, priority
-            )
-
-            matched.append({
-                "course_id": course_id,
-                "course_name": qdata.get("course_name", ""),
-                "unit_id": unit_id,
-                "unit_name": qdata.get("unit_name", ""),
-                "question_id": qid,
-                "score": liked_overlap,
-                "priority": priority
-            })
-
-        return matched
-
-    def group_and_rank(self, matched: List[Dict], top_k: int) -> List[Dict]:
-        grouped = {}
-
-        for item in matched:
-            key = (item["course_id"], item["unit_id"])
-            if key not in grouped:
-                grouped[key] = {
-                    "course_id": item["course_id"],
-                    "unit_id": item["unit_id"],
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "10. Matched question '%s': liked=%d, match_ratio=%.2f, dislike_ratio=%.2f, priority=%.2f",
+                    qid, liked_overlap, match_ratio, dislike_ratio, priority
+                )
+
+            key = (course_id, unit_id)
+            group = grouped.get(key)
+            if group is None:
+                group = grouped[key] = {
+                    "course_id": course_id,
+                    "course_name": "",
+                    "unit_id": unit_id,
+                    "unit_name": "",
                     "questions": [],
                     "priority": 0,
                     "total_score": 0
                 }
 
-            grouped[key]["questions"].append(item["question_id"])
-            grouped[key]["priority"] += item["priority"]
-            grouped[key]["total_score"] += item["score"]
-
-        for (course_id, unit_id), group in grouped.items():
-            course_doc = db.collection("courses").document(course_id).get()
-            group["course_name"] = course_doc.to_dict().get("name", "") if course_doc.exists else ""
+            # Questions carry their course/unit names; keep the first one seen.
+            if not group["course_name"]:
+                group["course_name"] = qdata.get("course_name", "")
+            if not group["unit_name"] and unit_id:
+                group["unit_name"] = qdata.get("unit_name", "")
+            group["questions"].append(qid)
+            group["priority"] += priority
+            group["total_score"] += liked_overlap
+
+        return grouped
+
+    def get_names(self, groups: List[Dict]) -> Tuple[Dict[str, str], Dict[Tuple[str, str], str]]:
+        course_ids = {g["course_id"] for g in groups if g["course_id"]}
+        unit_keys = {(g["course_id"], g["unit_id"]) for g in groups if g["course_id"] and g["unit_id"]}
+        refs = [db.collection("courses").document(course_id) for course_id in course_ids]
+        refs += [
+            db.collection("courses").document(course_id).collection("units").document(unit_id)
+            for course_id, unit_id in unit_keys
+        ]
 
-            if unit_id:
-                unit_doc = db.collection("courses").document(course_id).collection("units").document(unit_id).get()
-                group["unit_name"] = unit_doc.to_dict().get("name", "") if unit_doc.exists else ""
+        course_names = {}
+        unit_names = {}
+        if not refs:
+            return course_names, unit_names
+        for doc in db.get_all(refs, field_paths=["name"]):
+            if not doc.exists:
+                continue
+            name = doc.to_dict().get("name", "")
+            parent_course = doc.reference.parent.parent
+            if parent_course is None:
+                course_names[doc.id] = name
             else:
-                group["unit_name"] = ""
+                unit_names[(parent_course.id, doc.id)] = name
+        return course_names, unit_names
 
-        sorted_groups = sorted(
+    def group_and_rank(self, grouped: Dict[Tuple[str, str], Dict], top_k: int) -> List[Dict]:
+        top_results = heapq.nsmallest(
+            top_k,
             grouped.values(),
             key=lambda g: (-g["priority"], -g["total_score"])
         )
 
-        logging.info("11. Top %d groups sorted by priority and score", top_k)
-        for group in sorted_groups[:top_k]:
-            logging.info("   Group: Course '%s', Unit '%s', Priority=%.2f, Score=%d, Questions=%s",
-                        group["course_id"], group["unit_id"], group["priority"], group["total_score"], group["questions"])
-
-        top_results = sorted_groups[:top_k]
+        missing = [g for g in top_results if not g["course_name"] or (g["unit_id"] and not g["unit_name"])]
+        if missing:
+            course_names, unit_names = self.get_names(missing)
+            for group in missing:
+                if not group["course_name"]:
+                    group["course_name"] = course_names.get(group["course_id"], "")
+                if group["unit_id"] and not group["unit_name"]:
+                    group["unit_name"] = unit_names.get((group["course_id"], group["unit_id"]), "")
+
+        logger.info("11. Top %d groups sorted by priority and score", top_k)
+        for group in top_results:
+            logger.info("   Group: Course '%s', Unit '%s', Priority=%.2f, Score=%d, Questions=%s",
+                       group["course_id"], group["unit_id"], group["priority"], group["total_score"], group["questions"])
+
+        # Shuffle so the client doesn't always show the same group first.
         random.shuffle(top_results)
 
         return [
@@ -216,28 +330,34 @@ def find_similar_courses():
     if not uid or not course_id:
         return jsonify({"error": "Missing required fields"}), 400
 
-    logging.info("=== Starting similarity search for user '%s', course '%s', unit '%s' ===", uid, course_id, unit_id)
+    logger.info("=== Starting similarity search for user '%s', course '%s', unit '%s' ===", uid, course_id, unit_id)
 
     user_data = matcher.get_user_learning_state(uid, course_id)
     if not user_data:
         return jsonify({"error": "User not found"}), 404
 
+    cache_key = (uid, course_id, unit_id, use_units, top_k, matcher.get_learning_state_digest(user_data))
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Returning %d cached similar course-unit results", len(cached))
+        return jsonify({"similar_courses": random.sample(cached, len(cached))}), 200
+
     liked_ids = user_data.get("likedQuestions", [])
     disliked_ids = user_data.get("dislikedQuestions", [])
     answered_ids = set(user_data.get("answeredQuestions", []))
     subscribed_courses = set(user_data.get("subscribedCourses", []))
 
-    logging.info("12. Liked Questions: %s", liked_ids)
-    logging.info("13. Disliked Questions: %s", disliked_ids)
-    logging.info("14. Answered Questions: %s", answered_ids)
-    logging.info("15. Subscribed Courses: %s", subscribed_courses)
+    logger.info("12. Liked Questions: %s", liked_ids)
+    logger.info("13. Disliked Questions: %s", disliked_ids)
+    logger.info("14. Answered Questions: %s", answered_ids)
+    logger.info("15. Subscribed Courses: %s", subscribed_courses)
 
     liked_tags = matcher.get_question_tags(liked_ids)
     disliked_tags = matcher.get_question_tags(disliked_ids)
     course_tags = matcher.get_course_tags(course_id)
     unit_tags = matcher.get_unit_tags(course_id, unit_id) if use_units and unit_id else set()
 
-    matched = matcher.find_relevant_questions(
+    grouped = matcher.find_relevant_questions(
         liked_tags=liked_tags,
         disliked_tags=disliked_tags,
         course_tags=course_tags,
@@ -250,7 +370,8 @@ def find_similar_courses():
         reference_unit_id=unit_id if use_units else None
     )
 
-    result = matcher.group_and_rank(matched, top_k)
-    logging.info("16. Returning %d similar course-unit results", len(result))
+    result = matcher.group_and_rank(grouped, top_k)
+    result_cache.set(cache_key, result)
+    logger.info("16. Returning %d similar course-unit results", len(result))
 
     return jsonify({"similar_courses": result}), 200
\ No newline at end of file
@@ -1,10 +1,15 @@
+import logging
+import os
 from flask import Flask
 from flask_cors import CORS
 from Blueprints.QuestionMatcher import question_match
 from Blueprints.Classify import classify
+from util.json_provider import OrjsonProvider
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 app.register_blueprint(question_match)
 app.register_blueprint(classify)
@@ -0,0 +1,98 @@
+# Run from the repo root with `python -m scripts.backfill_tags` so the
+# firebase and util packages resolve.
+import logging
+import string
+from concurrent.futures import ThreadPoolExecutor
+from firebase.firebase import db
+from util.tags import split_tags
+
+# Firestore rejects batches with more than 500 writes.
+BATCH_SIZE = 500
+# Questions are scanned as this many independent partitions in parallel.
+PARTITION_COUNT = 8
+# Auto-generated document IDs are uniform over this alphabet, so splitting on
+# the first character gives evenly sized ranges.
+ID_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+class BatchWriter:
+    def __init__(self):
+        self.pending = []
+        self.written = 0
+
+    def update(self, ref, data: dict) -> None:
+        self.pending.append((ref, data))
+        if len(self.pending) == BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        batch = db.batch()
+        for ref, data in self.pending:
+            batch.update(ref, data)
+        try:
+            batch.commit()
+            self.written += len(self.pending)
+        except Exception as e:
+            # Batches are atomic, so one question deleted mid-run would drop every
+            # other update in it; retry them one by one and skip only the failures.
+            logging.warning("Batch of %d updates failed, retrying individually: %s", len(self.pending), e)
+            for ref, data in self.pending:
+                try:
+                    ref.update(data)
+                    self.written += 1
+                except Exception as e:
+                    logging.warning("Skipping %s: %s", ref.path, e)
+        self.pending = []
+
+def backfill_tags() -> int:
+    course_tags = {}
+    unit_tags = {}
+    for course in db.collection("courses").select(["tags"]).stream():
+        course_tags[course.id] = split_tags(course.to_dict().get("tags", []))
+        for unit in course.reference.collection("units").select(["tags"]).stream():
+            unit_tags[(course.id, unit.id)] = split_tags(unit.to_dict().get("tags", []))
+    logging.info("Loaded tags for %d courses and %d units", len(course_tags), len(unit_tags))
+
+    with ThreadPoolExecutor(max_workers=PARTITION_COUNT) as pool:
+        return sum(pool.map(
+            lambda query: backfill_question_partition(query, course_tags, unit_tags),
+            question_partitions()
+        ))
+
+def question_partitions() -> list:
+    # Collection group partitions would also read every nested "questions"
+    # subcollection, so the top-level collection is split on document ID instead.
+    questions = db.collection("questions")
+    step = len(ID_ALPHABET) / PARTITION_COUNT
+    bounds = [
+        {"__name__": questions.document(ID_ALPHABET[round(i * step)])}
+        for i in range(1, PARTITION_COUNT)
+    ]
+    partitions = []
+    for i in range(PARTITION_COUNT):
+        query = questions.order_by("__name__")
+        if i > 0:
+            query = query.start_at(bounds[i - 1])
+        if i < len(bounds):
+            query = query.end_before(bounds[i])
+        partitions.append(query)
+    return partitions
+
+def backfill_question_partition(query, course_tags: dict, unit_tags: dict) -> int:
+    writer = BatchWriter()
+    for doc in query.select(["tags", "course", "unit"]).stream():
+        qdata = doc.to_dict()
+        course_id = qdata.get("course")
+        effective = (
+            split_tags(qdata.get("tags", []))
+            | course_tags.get(course_id, set())
+            | unit_tags.get((course_id, qdata.get("unit")), set())
+        )
+        writer.update(doc.reference, {"effective_tags": sorted(effective)})
+    writer.flush()
+    return writer.written
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logging.info("Backfilled tags on %d documents", backfill_tags())
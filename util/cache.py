@@ -0,0 +1,41 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+def normalize_text(text: Optional[str]) -> str:
+    # Case and whitespace differences in free text should not cause misses.
+    return " ".join((text or "").lower().split())
+
+class ResponseCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 86400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        joined = "\x1f".join(str(part) for part in parts)
+        return hashlib.sha256(joined.encode("utf-8")).hexdigest()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
@@ -0,0 +1,40 @@
+import re
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, Set
+
+STOPWORDS = frozenset({"the", "and", "or", "of", "a", "an", "in", "on", "to", "for", "by", "with", "at", "from", "as", "is"})
+
+_SEPARATOR_TABLE = str.maketrans("-/", "  ")
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+
+@lru_cache(maxsize=8192)
+def normalize_tag(tag: str) -> FrozenSet[str]:
+    words = set()
+    tag = _PUNCTUATION_RE.sub("", tag.lower().translate(_SEPARATOR_TABLE))
+    for word in tag.split():
+        if word in STOPWORDS:
+            continue
+        if word.endswith("s") and len(word) > 3:
+            word = word[:-1]
+        words.add(word)
+    return frozenset(words)
+
+def split_tags(tags: Iterable[str]) -> Set[str]:
+    # Course and unit tags repeat across most candidates, so normalising each
+    # distinct tag string once is enough.
+    return set().union(*map(normalize_tag, tags))
+
+class TagVocabulary:
+    def __init__(self):
+        self.bits: Dict[str, int] = {}
+
+    def mask(self, tags: Iterable[str]) -> int:
+        # Assigns every new tag the next bit, so masks from one vocabulary can be
+        # intersected with & and counted with int.bit_count().
+        mask = 0
+        for tag in tags:
+            bit = self.bits.get(tag)
+            if bit is None:
+                bit = self.bits[tag] = 1 << len(self.bits)
+            mask |= bit
+        return mask